@@ -1,9 +1,19 @@
-import json
+import asyncio
+import contextlib
 import os
 import logging
-import uuid
+import secrets
+import string
+import time
 import base64
-from github import Github, GithubException
+
+import aioboto3
+import fastjsonschema
+import orjson
+from botocore.config import Config
+from gidgethub import GitHubException
+
+from github_helpers import create_github_client, get_cached_head_sha, get_repository
 
 # Set up logging
 logger = logging.getLogger()
@@ -13,148 +23,293 @@ logger.setLevel(logging.INFO)
 github_token = os.environ.get('GITHUB_TOKEN')
 github_repo_name = os.environ.get('GITHUB_REPO')  # Format: username/repo
 
+# Processed SQS message IDs are recorded here so redelivered messages are skipped.
+# A message is claimed as IN_PROGRESS and marked COMPLETED once processed; an
+# IN_PROGRESS claim older than the function timeout was abandoned and can be
+# reclaimed by a redelivery.
+idempotency_table = os.environ.get('IDEMPOTENCY_TABLE')
+IDEMPOTENCY_TTL = 86400  # 1 day
+IN_PROGRESS_EXPIRY = 300  # Matches the function Timeout in template.yaml
+STATUS_IN_PROGRESS = 'IN_PROGRESS'
+STATUS_COMPLETED = 'COMPLETED'
+
+# Clients live on this event loop for the lifetime of the container, so their
+# connections are reused by warm invocations
+BOTO_CONFIG = Config(max_pool_connections=20)
+_loop = asyncio.new_event_loop()
+_exit_stack = contextlib.AsyncExitStack()
+_clients = None
+
+# Request message schema, compiled once at import. Database names end up in
+# Terraform identifiers and file paths, so only names safe in both are allowed.
+_validate_request = fastjsonschema.compile({
+    'type': 'object',
+    'required': ['database_name', 'database_engine', 'environment'],
+    'properties': {
+        'database_name': {'type': 'string', 'pattern': '^[a-zA-Z][a-zA-Z0-9_-]{0,62}$'},
+        'database_engine': {'type': 'string', 'enum': ['mysql', 'postgresql']},
+        'environment': {'type': 'string', 'enum': ['dev', 'prod']}
+    }
+})
+
+# Terraform configuration for a requested RDS cluster
+_TF_TEMPLATE = string.Template('''
+# RDS Cluster for ${database_name}
+module "rds_${database_name}" {
+  source  = "../modules/rds"
+  
+  database_name       = "${database_name}"
+  database_engine     = "${database_engine}"
+  environment         = "${environment}"
+  instance_class      = "${instance_class}"
+  
+  vpc_id              = "vpc-0699cc0e1df9817df"
+  subnet_ids          = ["subnet-060138b65d7d9df55", "subnet-05c05a3a9519c0eea"]
+  allowed_cidr_blocks = ["10.0.0.0/16"]
+    
+  # Auto-cleanup tag for unused RDS instances
+  tags = {
+    Name            = "${database_name}"
+    Environment     = "${environment}"
+    auto-cleanup    = "true"
+    managed-by      = "terraform"
+    database-engine = "${database_engine}"
+  }
+}
+''')
+
+# Creates the branch, commits the Terraform file and opens the pull request in a
+# single request. Mutations in one document run in order, so each step sees the
+# result of the previous one.
+CREATE_PULL_REQUEST_MUTATION = '''
+mutation (
+  $repositoryId: ID!,
+  $repositoryNameWithOwner: String!,
+  $baseRefName: String!,
+  $branchName: String!,
+  $refName: String!,
+  $oid: GitObjectID!,
+  $headline: String!,
+  $path: String!,
+  $contents: Base64String!,
+  $title: String!,
+  $body: String!
+) {
+  createRef(input: {repositoryId: $repositoryId, name: $refName, oid: $oid}) {
+    ref { name }
+  }
+  createCommitOnBranch(input: {
+    branch: {repositoryNameWithOwner: $repositoryNameWithOwner, branchName: $branchName},
+    message: {headline: $headline},
+    fileChanges: {additions: [{path: $path, contents: $contents}]},
+    expectedHeadOid: $oid
+  }) {
+    commit { oid }
+  }
+  createPullRequest(input: {
+    repositoryId: $repositoryId,
+    baseRefName: $baseRefName,
+    headRefName: $branchName,
+    title: $title,
+    body: $body
+  }) {
+    pullRequest { url }
+  }
+}
+'''
+
 def lambda_handler(event, context):
+    # Process SQS messages
+    failed_message_ids = _loop.run_until_complete(_amain(event))
+    
+    # Report failed records so SQS only redelivers those; errors outside a single
+    # record propagate and fail the whole batch
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
+
+async def get_clients():
+    """
+    Return the shared DynamoDB and GitHub clients, creating them on first use
+    """
+    global _clients
+    if _clients is None:
+        session = aioboto3.Session()
+        dynamodb_client = await _exit_stack.enter_async_context(session.client('dynamodb', config=BOTO_CONFIG))
+        gh = create_github_client(github_token)
+        _clients = (dynamodb_client, gh)
+    return _clients
+
+async def _amain(event):
+    """
+    Process all records in the batch concurrently
+
+    Returns the message IDs of the records that failed.
+    """
+    # Share a single HTTP session and GitHub client across all records in the batch
+    dynamodb_client, gh = await get_clients()
+    results = await asyncio.gather(
+        *[handle_record(dynamodb_client, gh, record) for record in event['Records']],
+        return_exceptions=True
+    )
+    
+    # Let every record finish, then collect the failures
+    failed_message_ids = []
+    for record, result in zip(event['Records'], results):
+        if isinstance(result, Exception):
+            logger.error("Error processing message %s: %s", record['messageId'], result)
+            failed_message_ids.append(record['messageId'])
+    
+    return failed_message_ids
+
+async def handle_record(dynamodb_client, gh, record):
+    # Skip messages that SQS has already delivered and we have processed
+    if not await claim_message(dynamodb_client, record['messageId']):
+        logger.info("Skipping already processed message: %s", record['messageId'])
+        return
+    
     try:
-        # Process SQS messages
-        for record in event['Records']:
-            logger.info(f"Processing message: {record['messageId']}")
-            process_message(record)
-            
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'message': 'Messages processed successfully'})
-        }
+        await process_message(gh, record)
+    except Exception:
+        # Release the claim so a redelivery of this message is processed again
+        await release_message(dynamodb_client, record['messageId'])
+        raise
     
+    await complete_message(dynamodb_client, record['messageId'])
+
+async def claim_message(dynamodb_client, message_id):
+    """
+    Claim the message for processing, returning False if it was already processed
+    
+    Raises RuntimeError if another invocation is still processing the message,
+    so the record is reported as failed and redelivered later.
+    """
+    now = int(time.time())
+    try:
+        await dynamodb_client.put_item(
+            TableName=idempotency_table,
+            Item={
+                'messageId': {'S': message_id},
+                'status': {'S': STATUS_IN_PROGRESS},
+                'expiresAt': {'N': str(now + IN_PROGRESS_EXPIRY)},
+                'ttl': {'N': str(now + IDEMPOTENCY_TTL)}
+            },
+            ConditionExpression='attribute_not_exists(messageId) OR (#status = :in_progress AND expiresAt < :now)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':in_progress': {'S': STATUS_IN_PROGRESS},
+                ':now': {'N': str(now)}
+            }
+        )
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        response = await dynamodb_client.get_item(
+            TableName=idempotency_table,
+            Key={'messageId': {'S': message_id}},
+            ConsistentRead=True
+        )
+        if response.get('Item', {}).get('status', {}).get('S') == STATUS_COMPLETED:
+            return False
+        raise RuntimeError(f"Message {message_id} is already being processed")
+
+async def complete_message(dynamodb_client, message_id):
+    """
+    Mark the message as processed
+    """
+    try:
+        await dynamodb_client.update_item(
+            TableName=idempotency_table,
+            Key={'messageId': {'S': message_id}},
+            UpdateExpression='SET #status = :completed, #ttl = :ttl',
+            ExpressionAttributeNames={'#status': 'status', '#ttl': 'ttl'},
+            ExpressionAttributeValues={
+                ':completed': {'S': STATUS_COMPLETED},
+                ':ttl': {'N': str(int(time.time()) + IDEMPOTENCY_TTL)}
+            }
+        )
     except Exception as e:
-        logger.error(f"Error processing messages: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': 'Internal server error'})
-        }
+        # The pull request already exists, so don't fail the record over this
+        logger.warning("Could not mark message %s as completed: %s", message_id, e)
 
-def process_message(record):
+async def release_message(dynamodb_client, message_id):
+    """
+    Remove the processed marker for a message
+    """
+    try:
+        await dynamodb_client.delete_item(
+            TableName=idempotency_table,
+            Key={'messageId': {'S': message_id}}
+        )
+    except Exception as e:
+        logger.warning("Could not release message %s: %s", message_id, e)
+
+async def process_message(gh, record):
+    logger.info("Processing message: %s", record['messageId'])
+    
     # Parse the message
-    message_body = json.loads(record['body'])
+    message_body = orjson.loads(record['body'])
     
     # If the message came from SNS, extract the actual message
     if 'Type' in message_body and message_body['Type'] == 'Notification':
-        message_body = json.loads(message_body['Message'])
+        message_body = orjson.loads(message_body['Message'])
     
-    # Validate required fields
-    required_fields = ['database_name', 'database_engine', 'environment']
-    for field in required_fields:
-        if field not in message_body:
-            logger.error(f"Missing required field: {field}")
-            raise ValueError(f"Missing required field: {field}")
+    # Database engine and environment are case-insensitive
+    if isinstance(message_body, dict):
+        for field in ('database_engine', 'environment'):
+            if isinstance(message_body.get(field), str):
+                message_body[field] = message_body[field].lower()
+    
+    # Validate the request
+    try:
+        _validate_request(message_body)
+    except fastjsonschema.JsonSchemaException as e:
+        logger.error("Invalid request: %s", e.message)
+        raise ValueError(f"Invalid request: {e.message}") from e
     
     # Extract request details
     database_name = message_body['database_name']
-    database_engine = message_body['database_engine'].lower()
-    environment = message_body['environment'].lower()
-    
-    # Validate database engine
-    valid_engines = ['mysql', 'postgresql']
-    if database_engine not in valid_engines:
-        logger.error(f"Invalid database engine: {database_engine}")
-        raise ValueError(f"Invalid database engine. Supported engines: {', '.join(valid_engines)}")
-    
-    # Validate environment
-    valid_environments = ['dev', 'prod']
-    if environment not in valid_environments:
-        logger.error(f"Invalid environment: {environment}")
-        raise ValueError(f"Invalid environment. Supported environments: {', '.join(valid_environments)}")
-    
-    # Initialize GitHub client
-    g = Github(github_token)
-    repo = g.get_repo(github_repo_name)
+    database_engine = message_body['database_engine']
+    environment = message_body['environment']
     
     # Generate a unique branch name
-    branch_name = f"rds-request-{database_name}-{str(uuid.uuid4())[:8]}"
+    branch_name = f"rds-request-{database_name}-{secrets.token_hex(4)}"
     
-    # Get the default branch
-    default_branch = repo.default_branch
+    # Get the repository ID and default branch
+    repository_id, default_branch = await get_repository(gh, github_repo_name)
     
-    # Create a new branch
-    create_branch(repo, default_branch, branch_name)
+    # Get the SHA of the latest commit on the default branch
+    sha = await get_cached_head_sha(gh, github_repo_name, default_branch)
     
     # Generate Terraform configuration
     tf_config = generate_terraform_config(database_name, database_engine, environment)
     
-    # Commit Terraform configuration
-    commit_terraform_config(repo, branch_name, database_name, tf_config)
-    
-    # Create a pull request
-    create_pull_request(repo, branch_name, database_name, database_engine, environment, default_branch)
+    # Create a branch, commit the Terraform configuration and open a pull request
+    await create_pull_request(
+        gh, repository_id, default_branch, sha, branch_name,
+        database_name, database_engine, environment, tf_config
+    )
     
-    logger.info(f"Pull request created for {database_name} {database_engine} database in {environment} environment")
-
-def create_branch(repo, default_branch, branch_name):
-    try:
-        # Get the SHA of the latest commit on the default branch
-        default_branch_ref = repo.get_git_ref(f"heads/{default_branch}")
-        sha = default_branch_ref.object.sha
-        
-        # Create a new branch
-        repo.create_git_ref(ref=f"refs/heads/{branch_name}", sha=sha)
-        logger.info(f"Created branch: {branch_name}")
-    except GithubException as e:
-        logger.error(f"GitHub error creating branch: {str(e)}")
-        raise
+    logger.info("Pull request created for %s %s database in %s environment", database_name, database_engine, environment)
 
 def generate_terraform_config(database_name, database_engine, environment):
     # Generate Terraform configuration based on the request
     instance_class = 'db.t3.micro' if environment == 'dev' else 'db.t3.small'
     
-    tf_config = f'''
-# RDS Cluster for {database_name}
-module "rds_{database_name}" {{
-  source  = "../modules/rds"
-  
-  database_name       = "{database_name}"
-  database_engine     = "{database_engine}"
-  environment         = "{environment}"
-  instance_class      = "{instance_class}"
-  
-  vpc_id              = "vpc-0699cc0e1df9817df"
-  subnet_ids          = ["subnet-060138b65d7d9df55", "subnet-05c05a3a9519c0eea"]
-  allowed_cidr_blocks = ["10.0.0.0/16"]
-    
-  # Auto-cleanup tag for unused RDS instances
-  tags = {{
-    Name            = "{database_name}"
-    Environment     = "{environment}"
-    auto-cleanup    = "true"
-    managed-by      = "terraform"
-    database-engine = "{database_engine}"
-  }}
-}}
-'''
-    
-    return tf_config
+    return _TF_TEMPLATE.substitute(
+        database_name=database_name,
+        database_engine=database_engine,
+        environment=environment,
+        instance_class=instance_class
+    )
 
-def commit_terraform_config(repo, branch_name, database_name, tf_config):
+async def create_pull_request(gh, repository_id, default_branch, sha, branch_name,
+                              database_name, database_engine, environment, tf_config):
     try:
-        # Create a new file in the repository
         file_path = f"terraform/rds_{database_name}.tf"
         
-        # Encode content to base64
+        # createCommitOnBranch expects file contents as base64
         content = base64.b64encode(tf_config.encode()).decode()
         
-        # Create the file in the repository
-        repo.create_file(
-            path=file_path,
-            message=f'Add Terraform configuration for {database_name} RDS cluster',
-            content=tf_config,
-            branch=branch_name
-        )
-        
-        logger.info(f"Committed Terraform configuration to {file_path}")
-    except GithubException as e:
-        logger.error(f"GitHub error committing file: {str(e)}")
-        raise
-
-def create_pull_request(repo, branch_name, database_name, database_engine, environment, default_branch):
-    try:
         pr_title = f'Provision {database_name} {database_engine} RDS cluster for {environment}'
         pr_body = f'''
 ## RDS Cluster Request
@@ -166,15 +321,24 @@ def create_pull_request(repo, branch_name, database_name, database_engine, envir
 This PR was automatically generated by the RDS Cluster Automation Lambda.
         '''
         
-        # Create the pull request
-        pr = repo.create_pull(
+        # Create the branch, commit and pull request in one round trip
+        result = await gh.graphql(
+            CREATE_PULL_REQUEST_MUTATION,
+            repositoryId=repository_id,
+            repositoryNameWithOwner=github_repo_name,
+            baseRefName=default_branch,
+            branchName=branch_name,
+            refName=f"refs/heads/{branch_name}",
+            oid=sha,
+            headline=f'Add Terraform configuration for {database_name} RDS cluster',
+            path=file_path,
+            contents=content,
             title=pr_title,
-            body=pr_body,
-            head=branch_name,
-            base=default_branch
+            body=pr_body
         )
         
-        logger.info(f"Created pull request: {pr.html_url}")
-    except GithubException as e:
-        logger.error(f"GitHub error creating pull request: {str(e)}")
-        raise
\ No newline at end of file
+        logger.info("Created branch %s with Terraform configuration at %s", branch_name, file_path)
+        logger.info("Created pull request: %s", result['createPullRequest']['pullRequest']['url'])
+    except GitHubException as e:
+        logger.error("GitHub error creating pull request: %s", e)
+        raise
@@ -1,242 +1,352 @@
-import json
+import asyncio
+import contextlib
 import os
 import logging
-import uuid
-from datetime import datetime, timedelta
+import secrets
+from datetime import datetime, timedelta, timezone
 
-import boto3
-from github import Github, GithubException
+import aioboto3
+import orjson
+from botocore.config import Config
+
+from github_helpers import create_github_client, get_cached_head_sha, get_repository
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# AWS Clients
-cloudwatch_client = boto3.client('cloudwatch')
-rds_client = boto3.client('rds')
-
 # GitHub configuration
 github_token = os.environ.get('GITHUB_TOKEN')
 github_repo_name = os.environ.get('GITHUB_REPO')
 
+# AWS and GitHub clients are opened once per container on this loop
+BOTO_CONFIG = Config(max_pool_connections=50, retries={'mode': 'adaptive'})
+_loop = asyncio.new_event_loop()
+_exit_stack = contextlib.AsyncExitStack()
+_clients = None
+
+# Maximum number of instances cleaned up concurrently
+MAX_CONCURRENCY = 10
+
+# Maximum number of queries accepted by a single GetMetricData request
+MAX_METRIC_DATA_QUERIES = 500
+
+# Metrics to check for usage with the statistic and threshold for each, ordered
+# so that the most discriminating metric is evaluated first
+THRESHOLDS = {
+    'DatabaseConnections': ('Sum', 100),
+    'CPUUtilization': ('Average', 5),
+    'NetworkReceiveThroughput': ('Sum', 1 << 20),  # 1 MB
+    'NetworkTransmitThroughput': ('Sum', 1 << 20)  # 1 MB
+}
+
+# Creates the branch, commits the removal of the Terraform file and opens the pull
+# request in a single request. File deletions only need the path, so the file's
+# blob SHA does not have to be fetched first.
+CLEANUP_PULL_REQUEST_MUTATION = '''
+mutation (
+  $repositoryId: ID!,
+  $repositoryNameWithOwner: String!,
+  $baseRefName: String!,
+  $branchName: String!,
+  $refName: String!,
+  $oid: GitObjectID!,
+  $headline: String!,
+  $path: String!,
+  $title: String!,
+  $body: String!
+) {
+  createRef(input: {repositoryId: $repositoryId, name: $refName, oid: $oid}) {
+    ref { name }
+  }
+  createCommitOnBranch(input: {
+    branch: {repositoryNameWithOwner: $repositoryNameWithOwner, branchName: $branchName},
+    message: {headline: $headline},
+    fileChanges: {deletions: [{path: $path}]},
+    expectedHeadOid: $oid
+  }) {
+    commit { oid }
+  }
+  createPullRequest(input: {
+    repositoryId: $repositoryId,
+    baseRefName: $baseRefName,
+    headRefName: $branchName,
+    title: $title,
+    body: $body
+  }) {
+    pullRequest { url }
+  }
+}
+'''
+
 def lambda_handler(event, context):
     """
     Main Lambda handler to identify and delete unused RDS instances
     """
     try:
-        # Get all RDS instances
-        rds_instances = get_rds_instances()
-        
-        # Track number of instances processed
-        deleted_instances = 0
-        
-        # Check and delete unused instances
-        for instance in rds_instances:
-            if is_rds_unused(instance):
-                cleanup_unused_instance(instance)
-                deleted_instances += 1
+        rds_instances, deleted_instances = _loop.run_until_complete(_amain())
         
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'message': f'Processed {len(rds_instances)} instances. Deleted {deleted_instances} unused instances.'
-            })
+            }).decode()
         }
     
     except Exception as e:
-        logger.error(f"Error in RDS auto-cleanup: {str(e)}")
+        logger.error("Error in RDS auto-cleanup: %s", e)
         
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': 'RDS auto-cleanup failed'})
+            'body': orjson.dumps({'error': 'RDS auto-cleanup failed'}).decode()
         }
 
-def get_rds_instances():
+async def get_clients():
+    """
+    Return the shared CloudWatch, RDS and GitHub clients, creating them on first use
+    """
+    global _clients
+    if _clients is None:
+        session = aioboto3.Session()
+        cloudwatch_client = await _exit_stack.enter_async_context(session.client('cloudwatch', config=BOTO_CONFIG))
+        rds_client = await _exit_stack.enter_async_context(session.client('rds', config=BOTO_CONFIG))
+        gh = create_github_client(github_token)
+        _clients = (cloudwatch_client, rds_client, gh)
+    return _clients
+
+async def _amain():
+    """
+    Check all tagged instances and concurrently clean up the unused ones
+
+    Returns the list of instances found and the number of instances deleted.
+    """
+    cloudwatch_client, rds_client, gh = await get_clients()
+    
+    # Use one timestamp for the metrics window and snapshot names of this run
+    now = datetime.now(timezone.utc)
+    now_str = now.strftime('%Y%m%d%H%M%S')
+    
+    # Get all RDS instances, checking each full GetMetricData batch of instances
+    # for usage while the remaining pages are still being fetched
+    instances_per_batch = MAX_METRIC_DATA_QUERIES // len(THRESHOLDS)
+    rds_instances = []
+    classify_tasks = []
+    try:
+        async for instance in get_rds_instances(rds_client):
+            rds_instances.append(instance)
+            if len(rds_instances) % instances_per_batch == 0:
+                batch = rds_instances[-instances_per_batch:]
+                classify_tasks.append(asyncio.ensure_future(classify_instances(cloudwatch_client, batch, now)))
+    except BaseException:
+        # Don't leave checks pending on the shared loop, where they would resume
+        # during the next invocation
+        for task in classify_tasks:
+            task.cancel()
+        await asyncio.gather(*classify_tasks, return_exceptions=True)
+        raise
+    
+    remainder = len(rds_instances) % instances_per_batch
+    if remainder:
+        classify_tasks.append(asyncio.ensure_future(classify_instances(cloudwatch_client, rds_instances[-remainder:], now)))
+    
+    # Check which instances are unused
+    unused_identifiers = set().union(*await asyncio.gather(*classify_tasks))
+    
+    # Bound concurrency to stay within AWS and GitHub rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    
+    async def process(instance):
+        async with semaphore:
+            await cleanup_unused_instance(rds_client, gh, instance, now_str)
+    
+    # Delete unused instances
+    results = await asyncio.gather(
+        *(process(instance) for instance in rds_instances if instance['identifier'] in unused_identifiers),
+        return_exceptions=True
+    )
+    
+    # Track number of instances processed
+    deleted_instances = sum(1 for result in results if not isinstance(result, Exception))
+    
+    return rds_instances, deleted_instances
+
+async def get_rds_instances(rds_client):
     """
     Retrieve all RDS instances with specific tags for auto-cleanup
+    
+    Instances are yielded page by page as the paginated responses arrive.
     """
     try:
         # Describe DB instances with a specific tag for auto-cleanup
-        response = rds_client.describe_db_instances(
+        paginator = rds_client.get_paginator('describe_db_instances')
+        pages = paginator.paginate(
             Filters=[
                 {
                     'Name': 'tag:auto-cleanup',
                     'Values': ['true']
                 }
-            ]
+            ],
+            PaginationConfig={'PageSize': 100}
         )
         
-        return [
-            {
-                'identifier': instance['DBInstanceIdentifier'],
-                'engine': instance['Engine'],
-                'environment': next((tag['Value'] for tag in instance.get('TagList', []) if tag['Key'] == 'Environment'), 'unknown'),
-                'arn': instance['DBInstanceArn']
-            }
-            for instance in response['DBInstances']
-        ]
+        async for page in pages:
+            for instance in page['DBInstances']:
+                yield {
+                    'identifier': instance['DBInstanceIdentifier'],
+                    'engine': instance['Engine'],
+                    'environment': next((tag['Value'] for tag in instance.get('TagList', []) if tag['Key'] == 'Environment'), 'unknown'),
+                    'arn': instance['DBInstanceArn']
+                }
     except Exception as e:
-        logger.error(f"Error getting RDS instances: {str(e)}")
+        logger.error("Error getting RDS instances: %s", e)
         raise
 
-def is_rds_unused(instance):
+async def classify_instances(cloudwatch_client, instances, end_time):
     """
-    Check if an RDS instance has been unused for more than a week
+    Return the identifiers of RDS instances that have been unused in the week before end_time
     
     Checks multiple CloudWatch metrics:
     1. DatabaseConnections
     2. CPUUtilization
     3. NetworkReceiveThroughput
     4. NetworkTransmitThroughput
+    
+    All (instance, metric) pairs are fetched with batched GetMetricData
+    requests instead of one GetMetricStatistics call per pair.
     """
-    try:
-        # Define the time range (last week)
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(days=7)
-        
-        # Metrics to check for usage
-        metrics_to_check = [
-            'DatabaseConnections',
-            'CPUUtilization', 
-            'NetworkReceiveThroughput',
-            'NetworkTransmitThroughput'
-        ]
-        
-        # Check each metric
-        for metric_name in metrics_to_check:
-            response = cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/RDS',
-                MetricName=metric_name,
-                Dimensions=[
-                    {
-                        'Name': 'DBInstanceIdentifier',
-                        'Value': instance['identifier']
-                    }
-                ],
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=86400,  # Daily aggregation
-                Statistics=['Sum', 'Average']
-            )
-            
-            # If any metric shows significant activity, consider the instance in use
-            datapoints = response.get('Datapoints', [])
-            if datapoints:
-                # Different thresholds for different metrics
-                if metric_name == 'DatabaseConnections' and max(dp.get('Sum', 0) for dp in datapoints) > 100:
-                    return False
-                if metric_name == 'CPUUtilization' and max(dp.get('Average', 0) for dp in datapoints) > 5:
-                    return False
-                if metric_name in ['NetworkReceiveThroughput', 'NetworkTransmitThroughput']:
-                    if max(dp.get('Sum', 0) for dp in datapoints) > 1024*1024:  # 1 MB
-                        return False
-        
-        # If no significant activity found, mark for cleanup
-        return True
+    # Define the time range (last week)
+    start_time = end_time - timedelta(days=7)
     
-    except Exception as e:
-        logger.error(f"Error checking usage for {instance['identifier']}: {str(e)}")
-        # Default to not cleaning up if there's an error checking metrics
-        return False
+    # Build one query per instance and metric, keyed by a unique query id
+    queries = []
+    query_targets = {}
+    for idx, instance in enumerate(instances):
+        for metric_idx, (metric_name, (stat, _)) in enumerate(THRESHOLDS.items()):
+            query_id = f"m{idx}_{metric_idx}"
+            query_targets[query_id] = instance['identifier']
+            queries.append({
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/RDS',
+                        'MetricName': metric_name,
+                        'Dimensions': [
+                            {
+                                'Name': 'DBInstanceIdentifier',
+                                'Value': instance['identifier']
+                            }
+                        ]
+                    },
+                    'Period': 86400,  # Daily aggregation
+                    'Stat': stat
+                }
+            })
+    
+    # Collect the returned values for every query
+    values = {query_id: [] for query_id in query_targets}
+    in_use = set()
+    for offset in range(0, len(queries), MAX_METRIC_DATA_QUERIES):
+        chunk = queries[offset:offset + MAX_METRIC_DATA_QUERIES]
+        try:
+            next_token = None
+            while True:
+                kwargs = {'NextToken': next_token} if next_token else {}
+                response = await cloudwatch_client.get_metric_data(
+                    MetricDataQueries=chunk,
+                    StartTime=start_time,
+                    EndTime=end_time,
+                    ScanBy='TimestampDescending',
+                    **kwargs
+                )
+                for result in response.get('MetricDataResults', []):
+                    values[result['Id']].extend(result.get('Values', []))
+                
+                next_token = response.get('NextToken')
+                if not next_token:
+                    break
+        except Exception as e:
+            logger.error("Error fetching metrics: %s", e)
+            # Default to not cleaning up instances whose metrics could not be checked
+            in_use.update(query_targets[query['Id']] for query in chunk)
+    
+    # If any metric shows significant activity, consider the instance in use
+    unused = set()
+    for idx, instance in enumerate(instances):
+        if instance['identifier'] in in_use:
+            continue
+        if not any(
+            _metric_indicates_use(metric_name, values[f"m{idx}_{metric_idx}"])
+            for metric_idx, metric_name in enumerate(THRESHOLDS)
+        ):
+            # If no significant activity found, mark for cleanup
+            unused.add(instance['identifier'])
+    
+    return unused
+
+def _metric_indicates_use(metric_name, datapoints):
+    """
+    Check whether any datapoint of a metric is above its usage threshold
+    """
+    _, threshold = THRESHOLDS[metric_name]
+    return bool(datapoints) and max(datapoints) > threshold
 
-def cleanup_unused_instance(instance):
+async def cleanup_unused_instance(rds_client, gh, instance, now_str):
     """
     Cleanup unused RDS instances
-    1. Create final snapshot
-    2. Delete RDS instance
-    3. Create GitHub PR to remove Terraform configuration
+    1. Delete RDS instance, taking a final snapshot
+    2. Create GitHub PR to remove Terraform configuration
     """
     try:
-        # Create final snapshot
-        create_final_snapshot(instance)
-        
         # Delete RDS instance
-        delete_rds_instance(instance)
-        
-        # Initialize GitHub client
-        g = Github(github_token)
-        repo = g.get_repo(github_repo_name)
+        snapshot_identifier = f"{instance['identifier']}-final-snapshot-{now_str}"
+        await delete_rds_instance(rds_client, instance, snapshot_identifier)
         
         # Create GitHub PR to remove Terraform configuration
-        create_cleanup_pr(repo, instance)
+        await create_cleanup_pr(gh, instance)
         
-        logger.info(f"Cleaned up unused RDS instance: {instance['identifier']}")
+        logger.info("Cleaned up unused RDS instance: %s", instance['identifier'])
     
     except Exception as e:
-        logger.error(f"Error in cleanup process for {instance['identifier']}: {str(e)}")
+        logger.error("Error in cleanup process for %s: %s", instance['identifier'], e)
         raise
 
-def create_final_snapshot(instance):
-    """
-    Create a final snapshot before deletion for safety
-    """
-    try:
-        snapshot_identifier = f"{instance['identifier']}-final-snapshot-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
-        
-        rds_client.create_db_snapshot(
-            DBSnapshotIdentifier=snapshot_identifier,
-            DBInstanceIdentifier=instance['identifier']
-        )
-        
-        logger.info(f"Created final snapshot: {snapshot_identifier}")
-    except Exception as e:
-        logger.warning(f"Could not create final snapshot for {instance['identifier']}: {str(e)}")
-
-def delete_rds_instance(instance):
+async def delete_rds_instance(rds_client, instance, snapshot_identifier):
     """
     Delete the RDS instance
+    
+    RDS takes the final snapshot as part of the deletion, so no separate
+    snapshot is created beforehand.
     """
     try:
-        rds_client.delete_db_instance(
+        await rds_client.delete_db_instance(
             DBInstanceIdentifier=instance['identifier'],
             SkipFinalSnapshot=False,  # Ensures a final snapshot is created
-            FinalDBSnapshotIdentifier=f"{instance['identifier']}-final-snapshot-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+            FinalDBSnapshotIdentifier=snapshot_identifier
         )
         
-        logger.info(f"Deleted RDS instance: {instance['identifier']}")
+        logger.info("Deleted RDS instance: %s (final snapshot: %s)", instance['identifier'], snapshot_identifier)
     except Exception as e:
-        logger.error(f"Error deleting RDS instance {instance['identifier']}: {str(e)}")
+        logger.error("Error deleting RDS instance %s: %s", instance['identifier'], e)
         raise
 
-def create_cleanup_pr(repo, instance):
+async def create_cleanup_pr(gh, instance):
     """
     Create a GitHub PR to remove Terraform configuration
     """
     try:
         # Generate a unique branch name
-        branch_name = f"cleanup-rds-{instance['identifier']}-{str(uuid.uuid4())[:8]}"
+        branch_name = f"cleanup-rds-{instance['identifier']}-{secrets.token_hex(4)}"
         
-        # Get the default branch
-        default_branch = repo.default_branch
+        # Get the repository ID and default branch
+        repository_id, default_branch = await get_repository(gh, github_repo_name)
         
         # Get the SHA of the latest commit on the default branch
-        default_branch_ref = repo.get_git_ref(f"heads/{default_branch}")
-        sha = default_branch_ref.object.sha
-        
-        # Create a new branch
-        repo.create_git_ref(ref=f"refs/heads/{branch_name}", sha=sha)
+        sha = await get_cached_head_sha(gh, github_repo_name, default_branch)
         
         # Path to the Terraform configuration file
         file_path = f"terraform/rds_{instance['identifier']}.tf"
         
-        # Get the file's current content and SHA
-        try:
-            file_content = repo.get_contents(file_path, ref=repo.default_branch)
-            
-            # Delete the file
-            repo.delete_file(
-                path=file_path,
-                message=f'Remove unused RDS cluster {instance["identifier"]}',
-                sha=file_content.sha,
-                branch=branch_name
-            )
-        except Exception as not_found_error:
-            logger.warning(f"Terraform configuration file not found: {file_path}")
-        
-        # Create Pull Request
-        pr = repo.create_pull(
-            title=f'Remove Unused RDS: {instance["identifier"]}',
-            body=f'''
+        pr_body = f'''
 ## Automated RDS Cleanup
 
 Unused RDS instance identified and removed:
@@ -245,13 +355,25 @@ Unused RDS instance identified and removed:
 - **Environment**: {instance['environment']}
 
 Cleanup performed due to inactivity over the last week.
-            ''',
-            head=branch_name,
-            base=default_branch
+            '''
+        
+        # Create the branch, delete the file and open the pull request in one round trip
+        result = await gh.graphql(
+            CLEANUP_PULL_REQUEST_MUTATION,
+            repositoryId=repository_id,
+            repositoryNameWithOwner=github_repo_name,
+            baseRefName=default_branch,
+            branchName=branch_name,
+            refName=f"refs/heads/{branch_name}",
+            oid=sha,
+            headline=f'Remove unused RDS cluster {instance["identifier"]}',
+            path=file_path,
+            title=f'Remove Unused RDS: {instance["identifier"]}',
+            body=pr_body
         )
         
-        logger.info(f"Created cleanup PR: {pr.html_url}")
+        logger.info("Created cleanup PR: %s", result['createPullRequest']['pullRequest']['url'])
     
     except Exception as e:
-        logger.error(f"Error creating cleanup PR: {str(e)}")
-        raise
\ No newline at end of file
+        logger.error("Error creating cleanup PR: %s", e)
+        raise
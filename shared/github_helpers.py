@@ -0,0 +1,73 @@
+"""
+GitHub client and cached repository lookups shared by the processor and
+auto-cleanup Lambdas. Packaged as the SharedLayer Lambda layer.
+"""
+import asyncio
+import time
+
+import cachetools
+import httpx
+from gidgethub.httpx import GitHubAPI
+
+# Maximum number of connections to the GitHub API
+HTTP_POOL_SIZE = 20
+
+# The chained GraphQL mutations can take well over httpx's 5 second default, and
+# timing out after GitHub has applied them would leave the branch or PR behind
+HTTP_TIMEOUT = 30.0
+
+# Repository metadata and the default branch head SHA are reused across calls and
+# warm invocations. A slightly stale SHA is fine for branch creation since any
+# reachable commit works.
+REF_CACHE_TTL = 60
+_REPO_CACHE = {}
+_REF_CACHE = {}
+
+# Cache misses are fetched under a lock so that concurrent callers wait for a
+# single request instead of each sending the same one
+_repo_lock = asyncio.Lock()
+_ref_lock = asyncio.Lock()
+
+# ETags of GitHub GET responses, so repeated reads of the repository and default
+# branch ref are sent as conditional requests and answered with 304 Not Modified
+_github_cache = cachetools.LRUCache(maxsize=64)
+
+def create_github_client(oauth_token):
+    """
+    Create a GitHub client that multiplexes requests over HTTP/2
+    """
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(HTTP_TIMEOUT)
+    )
+    return GitHubAPI(http_client, "rds-bot", oauth_token=oauth_token, cache=_github_cache)
+
+async def get_repository(gh, repo_name):
+    """
+    Return the repository's GraphQL node ID and default branch, cached for REF_CACHE_TTL seconds
+    """
+    async with _repo_lock:
+        cached = _REPO_CACHE.get(repo_name)
+        if cached and time.monotonic() - cached[1] < REF_CACHE_TTL:
+            return cached[0]
+        
+        repo = await gh.getitem(f"/repos/{repo_name}")
+        repository = (repo['node_id'], repo['default_branch'])
+        _REPO_CACHE[repo_name] = (repository, time.monotonic())
+        return repository
+
+async def get_cached_head_sha(gh, repo_name, default_branch):
+    """
+    Return the SHA of the latest commit on the default branch, cached for REF_CACHE_TTL seconds
+    """
+    key = (repo_name, default_branch)
+    async with _ref_lock:
+        cached = _REF_CACHE.get(key)
+        if cached and time.monotonic() - cached[1] < REF_CACHE_TTL:
+            return cached[0]
+        
+        default_branch_ref = await gh.getitem(f"/repos/{repo_name}/git/ref/heads/{default_branch}")
+        sha = default_branch_ref['object']['sha']
+        _REF_CACHE[key] = (sha, time.monotonic())
+        return sha